@@ -1,19 +1,48 @@
 #!/usr/bin/env python3
 # Copyright Vespa.ai. All rights reserved.
+import argparse
+import collections
 import copy
+import functools
+import hashlib
 import json
+import multiprocessing
+import os
 import sys
+import time
 from bs4 import BeautifulSoup
-from markdownify import markdownify
-import random
+from markdownify import MarkdownConverter
 import re
 from xml.sax.saxutils import escape
 import tiktoken
 import urllib.parse
 
-encoding = tiktoken.encoding_for_model("gpt-4o-mini")
+token_model = "gpt-4o-mini"
 note_pattern = re.compile(r"{%\s*include.*?%}", flags=re.DOTALL)
 highlight_pattern = re.compile(r"{%\s*.*?\s%}", flags=re.DOTALL)
+xml_highlight_pattern = re.compile(r"({%\s*highlight xml\s*%})(.*?)({%\s*endhighlight\s*%})", flags=re.DOTALL)
+# All paragraph cleanup in one scan: fences with the newlines around them and a following language,
+# other newline runs, backslashes and Jekyll tags. The leading lookahead lets the scan skip to
+# the characters that can start a match.
+normalize_pattern = re.compile(
+    r"(?=[\n`\\{])(?:"
+    r"(?P<fence>\n*```(?=\n*```))"
+    r"|(?P<block>\n*```\n*(?P<language>json|xml|bash|sh|rawjava|raw|java)?)"
+    r"|(?P<newlines>\n{2,})"
+    r"|(?P<backslash>\\)"
+    r"|(?P<jekyll>{%\s*include.*?%}|{%\s*.*?\s%}))", flags=re.DOTALL)
+# Text after a fence: the language is put on the fence line, raw is dropped (also when followed by java)
+fence_languages = {None: "\n", "json": "json", "xml": "xml", "bash": "bash", "sh": "sh", "raw": "\n", "java": "java\n",
+                   "rawjava": "java\n"}
+list_item_pattern = re.compile(r"\s*([*+-]|\d+\.)\s")
+# Where text too large for a chunk is cut, in order: at lines, sentences and words
+unit_cut_patterns = [re.compile(r"\n"), re.compile(r"(?<=[.!?])[ \t]+"), re.compile(r"[ \t]+")]
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding():
+    # Loaded on first use, so importing from this module does not load the encoding
+    return tiktoken.encoding_for_model(token_model)
 
 
 def what_language(el):
@@ -33,6 +62,11 @@ def remove_jekyll(text):
     return text
 
 def xml_fixup(text):
+    # Escape the content of xml highlight blocks, in one pass over the document
+    return xml_highlight_pattern.sub(lambda m: m.group(1) + escape(m.group(2)) + m.group(3), text)
+
+def xml_fixup_chain(text):
+    # Previous implementation of xml_fixup, kept as reference for --benchmark-normalize
     regex = r"{%\s*highlight xml\s*%}(.*?){%\s*endhighlight\s*%}"
     matches = re.findall(regex, text, re.DOTALL)
     for match in matches:
@@ -47,7 +81,7 @@ def is_selfhosted_doc(doc):
         return True
     return False
 
-def create_text_doc(doc, paragraph, paragraph_id, header):
+def create_text_doc(doc, paragraph, paragraph_id, header, n_tokens, base_uri, part=1):
     id = doc['put']
     #id:open:doc::open/en/access-logging.html#
     _,namespace,doc_type,_,id = id.split(":")
@@ -56,7 +90,6 @@ def create_text_doc(doc, paragraph, paragraph_id, header):
     new_namespace = namespace + "-p"
     id = "id:{}:{}::{}".format(new_namespace, "paragraph", id)
     fields = doc['fields']
-    n_tokens = len(encoding.encode(paragraph))
     new_doc = {
         "put": id,
         "fields": {
@@ -66,7 +99,7 @@ def create_text_doc(doc, paragraph, paragraph_id, header):
             "namespace": new_namespace,
             "content": paragraph,
             "content_tokens": n_tokens,
-            "base_uri": sys.argv[2],
+            "base_uri": base_uri,
             "selfhosted": is_selfhosted_doc(doc)
         }
     }
@@ -76,36 +109,113 @@ def create_text_doc(doc, paragraph, paragraph_id, header):
         new_title = title + " - " + header
         new_doc["fields"]["title"] = new_title
 
-    if paragraph_id is None:
-        paragraph_id = str(random.randint(0,1000))
-
     new_doc['fields']['path'] = new_doc['fields']['path'] + \
         "#" + paragraph_id.replace("?", "")
     new_doc['put'] = new_doc['put'] + "-" + urllib.parse.quote(paragraph_id)
+    if part > 1:
+        # Chunks of a paragraph link to the same heading, but are separate documents
+        new_doc['put'] = new_doc['put'] + "-part-" + str(part)
 
     return new_doc
 
 
-def split_text(soup):
+def unique_paragraph_ids(paragraphs):
+    # Ids are derived from headings, and paragraphs before the first heading get the empty id.
+    # Repeated ids in a page get -1, -2, ... suffixes, so ids do not depend on other pages
+    # and every paragraph in a page is its own document.
+    ids = set()
+    renamed = 0
+    result = []
+    for paragraph_id, header, paragraph, n_tokens in paragraphs:
+        unique_id = paragraph_id
+        n = 0
+        while unique_id in ids:
+            n += 1
+            unique_id = "{0}-{1}".format(paragraph_id, n)
+        if n > 0:
+            renamed += 1
+        ids.add(unique_id)
+        result.append((unique_id, header, paragraph, n_tokens))
+    return result, renamed
+
+
+def normalize_match(m):
+    kind = m.lastgroup
+    if kind == "fence":
+        # A fence directly followed by another fence gets no newline of its own
+        return "\n```"
+    if kind == "block" or kind == "language":
+        return "\n```" + fence_languages[m.group("language")]
+    if kind == "newlines":
+        return "\n\n"
+    # Necessary backslashes and quotes will be added when json-serialized.
+    return ""
+
+
+def clean_paragraph(paragraph):
+    paragraph = paragraph.lstrip('\n').lstrip(" ")
+    paragraph = paragraph.rstrip('\n')
+    return normalize_pattern.sub(normalize_match, paragraph)
+
+
+def clean_paragraph_chain(paragraph):
+    # Previous implementation of clean_paragraph, kept as reference for --benchmark-normalize
+    paragraph = paragraph.lstrip('\n').lstrip(" ")
+    paragraph = paragraph.rstrip('\n')
+
+    paragraph = re.sub(r"\n{2,}", "\n\n", paragraph)
+
+    paragraph = re.sub(r"\n*```", "\n```", paragraph)
+    paragraph = re.sub(r"```\n*", "```\n", paragraph)
+
+    paragraph = paragraph.replace("```\njson","```json")
+    paragraph = paragraph.replace("```\nxml","```xml")
+    paragraph = paragraph.replace("```\nbash","```bash")
+    paragraph = paragraph.replace("```\nsh","```sh")
+    paragraph = paragraph.replace("```\nraw","```\n")
+    paragraph = paragraph.replace("```\njava","```java\n")
+
+    # Necessary backslashes and quotes will be added when json-serialized.
+    paragraph = paragraph.replace("\\", "")
+
+    return remove_jekyll(paragraph)
+
+
+class ParagraphConverter(MarkdownConverter):
+    # Headings are rendered as a marker with the heading number, so that the Markdown of a page
+    # is cut into paragraphs at heading elements, not at lines that happen to start with #
+    marker = "\x00"
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.headers = []
+
+    def convert_hN(self, n, el, text, parent_tags):
+        if '_inline' in parent_tags:
+            return text
+        self.headers.append(" ".join(text.split()))
+        return "\n\n{0}{1}{0}\n\n".format(self.marker, len(self.headers) - 1)
+
+
+def split_text(soup, clean=clean_paragraph):
     split_tables(soup)
     split_lists(soup)
-    md = markdownify(str(soup), heading_style='ATX', code_language_callback=what_language)
-    lines = md.split("\n")
+    # Convert the tree directly instead of serializing and parsing it again with html.parser.
+    # Adjacent strings are merged first, as they would be by parsing the serialized tree.
+    soup.smooth()
+    converter = ParagraphConverter(heading_style='ATX', code_language_callback=what_language)
+    parts = converter.convert_soup(soup).split(ParagraphConverter.marker)
+    # Parts alternate between paragraph text and the number of the heading starting the next paragraph
     header = ""
-    text = ""
     id = ""
     data = []
-    for line in lines:
-        if line.startswith("#"):
-            if text:
-                data.append((id, header, text))
-                text = ""
-            header = line.lstrip("#").replace("\\", "")
+    for i in range(0, len(parts), 2):
+        if i > 0:
+            header = " " + converter.headers[int(parts[i - 1])].replace("\\", "")
             id = "-".join(header.replace(',', '').split()).lower()
-        else:
-            text = text + "\n" + line
-
-    data.append((id, header, text)) #Flush any last data
+        paragraph = clean(parts[i])
+        if paragraph:
+            data.append((id, header, paragraph))
     return data
 
 
@@ -195,65 +305,466 @@ def fix_pre_content(soup):
         pre.string = re.sub(r'^#', ' #', pre_text, flags=re.MULTILINE)
 
 
-def main():
-    with open(sys.argv[1]) as fp:
-        random.seed(42)
-        docs = json.load(fp)
-        operations = []
-        for doc in docs:
-            html_doc = doc['fields']['html']
-            html_doc = xml_fixup(html_doc)
-            soup = BeautifulSoup(html_doc, 'html5lib')
-            remove_notext_tags(soup)
-            fix_pre_content(soup)
-            add_header_to_tables_if_missing(soup)
-            data = split_text(soup)
-
-            for paragraph_id, header, paragraph in data:
-
-                paragraph = paragraph.lstrip('\n').lstrip(" ")
-                paragraph = paragraph.rstrip('\n')
-
-                paragraph = re.sub(r"\n{2,}", "\n\n", paragraph)
-
-                paragraph = re.sub(r"\n*```", "\n```", paragraph)
-                paragraph = re.sub(r"```\n*", "```\n", paragraph)
-
-                paragraph = paragraph.replace("```\njson","```json")
-                paragraph = paragraph.replace("```\nxml","```xml")
-                paragraph = paragraph.replace("```\nbash","```bash")
-                paragraph = paragraph.replace("```\nsh","```sh")
-                paragraph = paragraph.replace("```\nraw","```\n")
-                paragraph = paragraph.replace("```\njava","```java\n")
-
-                # Necessary backslashes and quotes will be added when json-serialized.
-                paragraph = paragraph.replace("\\", "")
-
-                paragraph = remove_jekyll(paragraph)
-
-                if paragraph:
-                    paragraph_doc = create_text_doc(doc, paragraph, paragraph_id, header)
-                    operations.append(paragraph_doc)
-
-    #Merge question expansion
-    questions_expansion = dict()
-    with open(sys.argv[3]) as fp:
-        for line in fp:
-            op = json.loads(line)
-            id = op['update']
-            fields = op['fields']
-            if "questions" in fields:
-                questions = fields['questions']['assign']
-                questions_expansion[id] = questions
-    for op in operations:
-        id = op['put']
-        if id in questions_expansion:
-            op['fields']['questions'] = questions_expansion[id]
+def split_doc(doc, clean=clean_paragraph):
+    html_doc = doc['fields']['html']
+    html_doc = xml_fixup(html_doc)
+    soup = BeautifulSoup(html_doc, 'html5lib')
+    remove_notext_tags(soup)
+    fix_pre_content(soup)
+    add_header_to_tables_if_missing(soup)
+    return split_text(soup, clean)
+
+
+class TokenCache:
+    # Token counts per paragraph, keyed by a hash of the paragraph text, with least recently used eviction.
+    # Boilerplate paragraphs repeat across pages and runs, and are only encoded once.
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.isfile(path):
+            with open(path) as fp:
+                cache = json.load(fp)
+            if cache.get("model") == token_model:
+                self.entries.update(cache["entries"])
+
+    def count(self, paragraphs):
+        keys = [hashlib.sha256(paragraph.encode('utf-8')).hexdigest() for paragraph in paragraphs]
+        missing = {}
+        for key, paragraph in zip(keys, paragraphs):
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            elif key not in missing:
+                missing[key] = paragraph
+                self.misses += 1
+            else:
+                self.hits += 1
+        if missing:
+            encoded = get_encoding().encode_batch(list(missing.values()))
+            for key, tokens in zip(missing, encoded):
+                self.entries[key] = len(tokens)
+        counts = [self.entries[key] for key in keys]
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return counts
+
+    def save(self):
+        if self.path is None:
+            return
+        with open(self.path, "w") as fp:
+            json.dump({"model": token_model, "entries": self.entries}, fp)
+        print("Token cache: {0} hits, {1} misses".format(self.hits, self.misses))
+
+
+class SplitCache:
+    # Split results per document, keyed by a hash of everything that goes into a paragraph doc.
+    # Bump the version when the splitting changes, to invalidate existing cache files.
+    version = 1
+
+    def __init__(self, path, base_uri):
+        self.path = path
+        self.base_uri = base_uri
+        self.entries = {}
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+        if path is not None and os.path.isfile(path):
+            with open(path) as fp:
+                cache = json.load(fp)
+            if cache.get("version") == self.version:
+                self.entries = cache["entries"]
+
+    def key(self, doc):
+        # Without a cache file, nothing is looked up or kept in memory
+        if self.path is None:
+            return None
+        fields = doc['fields']
+        content = json.dumps([fields['html'], fields['title'], fields['path'], self.base_uri])
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        if key is None:
+            return None
+        paragraphs = self.entries.get(key)
+        if paragraphs is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.used[key] = paragraphs
+        return paragraphs
+
+    def put(self, key, paragraphs):
+        if key is not None:
+            self.used[key] = paragraphs
+
+    def save(self):
+        if self.path is None:
+            return
+        # Only keep entries used in this run, evicting removed and changed documents
+        evicted = len(self.entries.keys() - self.used.keys())
+        with open(self.path, "w") as fp:
+            json.dump({"version": self.version, "entries": self.used}, fp)
+        print("Split cache: {0} hits, {1} misses, {2} evicted".format(self.hits, self.misses, evicted))
+
+
+def read_docs(path):
+    # Read documents one by one from a JSON array or JSONL file, without loading the whole file
+    with open(path, encoding='utf-8') as fp:
+        if path.endswith(".jsonl"):
+            for line in fp:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        decoder = json.JSONDecoder()
+        buffer = ""
+        pos = 0
+        started = False
+        eof = False
+        while True:
+            while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ",")):
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError("Unexpected end of file in {0}".format(path))
+                chunk = fp.read(1 << 20)
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                eof = not chunk
+                continue
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError("Expected a JSON array in {0}".format(path))
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                doc, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = fp.read(1 << 20)
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                eof = not chunk
+                continue
+            yield doc
+
+
+def batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def split_docs(docs, jobs, cache, tokens):
+    # Parsing and splitting is CPU bound - shard the documents not in cache over a process pool.
+    # Documents are processed in bounded batches, and results are returned in input order,
+    # so ids and output are the same as a serial run.
+    # Tokens are counted here for all new paragraphs in a batch at once, using the token cache.
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        for batch in batches(docs, 16 * jobs):
+            keys = [cache.key(doc) for doc in batch]
+            cached = [cache.get(key) for key in keys]
+            missing = [doc for doc, paragraphs in zip(batch, cached) if paragraphs is None]
+            results = list(pool.map(split_doc, missing) if pool else map(split_doc, missing))
+            counts = iter(tokens.count([paragraph for result in results for _, _, paragraph in result]))
+            results = iter(results)
+            for doc, key, paragraphs in zip(batch, keys, cached):
+                if paragraphs is None:
+                    paragraphs = [(paragraph_id, header, paragraph, next(counts))
+                                  for paragraph_id, header, paragraph in next(results)]
+                    cache.put(key, paragraphs)
+                yield doc, paragraphs
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def split_units(paragraph):
+    # Cut a paragraph where it can be chunked: at blank lines, list items and code fences.
+    # A fenced code block is one unit. Each unit is returned with the text separating it from
+    # the previous unit, so that joining all units gives back the paragraph.
+    units = []
+    lines = []
+    blanks = []
+    in_fence = False
+
+    def flush():
+        nonlocal lines, blanks
+        if lines:
+            separator = "".join(blank + "\n" for blank in blanks)
+            units.append((("\n" + separator) if units else separator, "\n".join(lines)))
+            lines = []
+            blanks = []
+
+    for line in paragraph.split("\n"):
+        if line.startswith("```"):
+            if not in_fence:
+                flush()
+            lines.append(line)
+            if in_fence:
+                flush()
+            in_fence = not in_fence
+        elif in_fence:
+            lines.append(line)
+        elif not line.strip():
+            flush()
+            blanks.append(line)
         else:
+            if list_item_pattern.match(line):
+                flush()
+            lines.append(line)
+    flush()
+    if blanks:
+        separator, text = units.pop() if units else ("", "")
+        units.append((separator, text + "".join("\n" + blank for blank in blanks)))
+    return units
+
+
+def cut_unit(text, tokens, max_tokens, level=0):
+    # Cuts text larger than max_tokens into (separator, text) pieces of at most max_tokens each, at the first of
+    # unit_cut_patterns that gives small enough pieces. Words are cut at max_tokens bytes, as a token is at least a byte.
+    if level == len(unit_cut_patterns):
+        pieces = []
+        start = 0
+        size = 0
+        for i, c in enumerate(text):
+            n = len(c.encode('utf-8'))
+            if size + n > max_tokens and i > start:
+                pieces.append(("", text[start:i]))
+                start = i
+                size = 0
+            size += n
+        pieces.append(("", text[start:]))
+        return pieces
+    parts = []
+    separator = ""
+    start = 0
+    for m in unit_cut_patterns[level].finditer(text):
+        parts.append((separator, text[start:m.start()]))
+        separator = m.group()
+        start = m.end()
+    parts.append((separator, text[start:]))
+    pieces = []
+    for (separator, part), count in zip(parts, tokens.count([separator + part for separator, part in parts])):
+        if count <= max_tokens:
+            pieces.append((separator, part))
+        else:
+            cut = cut_unit(part, tokens, max_tokens - len(separator.encode('utf-8')), level + 1)
+            pieces.append((separator + cut[0][0], cut[0][1]))
+            pieces.extend(cut[1:])
+    return pieces
+
+
+def chunk_paragraph(paragraph, n_tokens, tokens, max_tokens, overlap_tokens, min_tokens):
+    # Pack units into chunks of at most max_tokens (summed per unit), where each chunk after the first
+    # starts with the last units of the previous chunk, up to overlap_tokens.
+    # Units too large on their own are cut with cut_unit, except code blocks: a chunk with a code block
+    # larger than max_tokens is the only chunk exceeding it.
+    # A last chunk with less than min_tokens of new content is merged into the previous chunk, if that fits.
+    if n_tokens <= max_tokens:
+        return [(paragraph, n_tokens)]
+    units = split_units(paragraph)
+    counts = tokens.count([separator + text for separator, text in units])
+    if max(counts) > max_tokens:
+        cut_units = []
+        for (separator, text), count in zip(units, counts):
+            if count <= max_tokens or text.startswith("```"):
+                cut_units.append((separator, text))
+            else:
+                cut = cut_unit(text, tokens, max_tokens - len(separator.encode('utf-8')))
+                cut_units.append((separator + cut[0][0], cut[0][1]))
+                cut_units.extend(cut[1:])
+        units = cut_units
+        counts = tokens.count([separator + text for separator, text in units])
+
+    chunks = []
+    current = []
+    size = 0
+    for i, count in enumerate(counts):
+        if current and size + count > max_tokens:
+            chunks.append(current)
+            current = []
+            size = 0
+            for j in reversed(chunks[-1]):
+                if size + counts[j] > min(overlap_tokens, max_tokens - count):
+                    break
+                current.insert(0, j)
+                size += counts[j]
+        current.append(i)
+        size += count
+    new = [j for j in current if not chunks or j > chunks[-1][-1]]
+    if chunks and sum(counts[j] for j in new) < min_tokens and sum(counts[j] for j in chunks[-1] + new) <= max_tokens:
+        chunks[-1] += new
+    else:
+        chunks.append(current)
+
+    texts = ["".join((units[j][0] if n > 0 or j == 0 else "") + units[j][1] for n, j in enumerate(chunk)) for chunk in chunks]
+    return list(zip(texts, tokens.count(texts)))
+
+
+class QuestionExpansions:
+    # Question expansions per paragraph id, read line by line from a JSONL file of update operations.
+    # Ids and questions are interned, and questions kept as tuples, as the same questions repeat.
+    def __init__(self, questions_file):
+        self.questions = {}
+        self.matched = set()
+        self.unmatched = []
+        with open(questions_file) as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                op = json.loads(line)
+                fields = op['fields']
+                if "questions" in fields:
+                    questions = fields['questions']['assign']
+                    self.questions[sys.intern(op['update'])] = tuple(sys.intern(question) for question in questions)
+
+    def merge(self, op):
+        # Paragraphs without expansions get their title as question
+        id = op['put']
+        questions = self.questions.get(id)
+        if questions is None:
+            self.unmatched.append(id)
             op['fields']['questions'] = [op['fields']['title']]
+        else:
+            self.matched.add(id)
+            op['fields']['questions'] = questions
+
+    def report(self, path):
+        # Orphaned expansions are for paragraphs that no longer exist, e.g. after a heading was changed
+        orphaned = sorted(self.questions.keys() - self.matched)
+        print("Question expansions: {0} matched, {1} paragraphs without expansions, {2} orphaned expansions".format(
+            len(self.matched), len(self.unmatched), len(orphaned)))
+        if path is not None:
+            with open(path, "w") as fp:
+                json.dump({"matched": len(self.matched), "unmatched": self.unmatched, "orphaned": orphaned}, fp, indent=2)
+
+
+class OperationWriter:
+    # Writes operations as they are produced, as a JSON array (same format as json.dump) or as JSONL
+    def __init__(self, fp, jsonl):
+        self.fp = fp
+        self.jsonl = jsonl
+        self.count = 0
+
+    def __enter__(self):
+        if not self.jsonl:
+            self.fp.write("[")
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.jsonl:
+            self.fp.write("]")
+
+    def write(self, op):
+        if self.jsonl:
+            self.fp.write(json.dumps(op))
+            self.fp.write("\n")
+        else:
+            if self.count > 0:
+                self.fp.write(", ")
+            self.fp.write(json.dumps(op))
+        self.count += 1
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Split documents in a Vespa feed into paragraphs")
+    parser.add_argument("index", help="feed file with documents to split, JSON array or JSONL, e.g. open_index.json")
+    parser.add_argument("base_uri", help="base URI for the documents, e.g. https://docs.vespa.ai")
+    parser.add_argument("questions", help="JSONL file with question expansions per paragraph")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="number of worker processes used for splitting (default: 1)")
+    parser.add_argument("--cache", metavar="FILE",
+                        help="cache file for split results, unchanged documents are not split again")
+    parser.add_argument("--token-cache", metavar="FILE",
+                        help="cache file for paragraph token counts, kept across runs")
+    parser.add_argument("--token-cache-size", type=int, default=100000,
+                        help="max number of paragraph token counts kept in the token cache (default: 100000)")
+    parser.add_argument("--max-tokens", type=int,
+                        help="split paragraphs larger than this many tokens into chunks, at blank lines, list items and code blocks, "
+                             "then at lines, sentences and words. Only chunks with a larger code block exceed this")
+    parser.add_argument("--overlap-tokens", type=int, default=0,
+                        help="with --max-tokens, max number of tokens repeated from the end of the previous chunk (default: 0)")
+    parser.add_argument("--min-tokens", type=int, default=32,
+                        help="with --max-tokens, a last chunk smaller than this is merged into the previous chunk (default: 32)")
+    parser.add_argument("--benchmark-normalize", action="store_true",
+                        help="time the single pass paragraph cleanup against the previous chain of regexes on all documents, and check the output is identical")
+    parser.add_argument("--questions-report", metavar="FILE",
+                        help="write the ids of paragraphs without question expansions and of orphaned expansions to FILE, as JSON")
+    parser.add_argument("-o", "--output", default="paragraph_index.json",
+                        help="output feed file, written as JSONL if it ends with .jsonl (default: paragraph_index.json)")
+    return parser.parse_args()
+
+
+def benchmark_normalize(docs, repeat=5):
+    # Time the single pass xml_fixup and clean_paragraph against the previous chains on the corpus,
+    # and check that they produce the same output
+    pages = []
+    sections = []
+    for doc in docs:
+        pages.append(doc['fields']['html'])
+        sections.extend(paragraph for _, _, paragraph in split_doc(doc, clean=lambda paragraph: paragraph))
+
+    identical = True
+    for name, inputs, chain, single in [("xml_fixup", pages, xml_fixup_chain, xml_fixup),
+                                        ("clean_paragraph", sections, clean_paragraph_chain, clean_paragraph)]:
+        differences = sum(1 for text in inputs if chain(text) != single(text))
+        times = []
+        for function in (chain, single):
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for text in inputs:
+                    function(text)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            times.append(best)
+        print("{0}: {1} inputs, chain {2:.3f}s, single pass {3:.3f}s ({4:.1f}x), {5} differ".format(
+            name, len(inputs), times[0], times[1], times[0] / times[1], differences))
+        identical = identical and differences == 0
+    return identical
+
 
-    with open("paragraph_index.json", "w") as fp:
-        json.dump(operations, fp)
+def main():
+    args = parse_args()
+    if args.benchmark_normalize:
+        sys.exit(0 if benchmark_normalize(read_docs(args.index)) else 1)
+
+    questions = QuestionExpansions(args.questions)
+    cache = SplitCache(args.cache, args.base_uri)
+    tokens = TokenCache(args.token_cache, args.token_cache_size)
+    renamed = 0
+
+    with open(args.output, "w") as fp, OperationWriter(fp, args.output.endswith(".jsonl")) as writer:
+        for doc, paragraphs in split_docs(read_docs(args.index), args.jobs, cache, tokens):
+            paragraphs, doc_renamed = unique_paragraph_ids(paragraphs)
+            renamed += doc_renamed
+            for paragraph_id, header, paragraph, n_tokens in paragraphs:
+                chunks = [(paragraph, n_tokens)]
+                if args.max_tokens:
+                    chunks = chunk_paragraph(paragraph, n_tokens, tokens, args.max_tokens, args.overlap_tokens, args.min_tokens)
+                for part, (content, content_tokens) in enumerate(chunks, 1):
+                    op = create_text_doc(doc, content, paragraph_id, header, content_tokens, args.base_uri, part)
+                    questions.merge(op)
+                    writer.write(op)
+    questions.report(args.questions_report)
+    if renamed > 0:
+        print("Renamed {0} duplicate paragraph ids".format(renamed))
+    cache.save()
+    tokens.save()
 
 
 if __name__ == "__main__":
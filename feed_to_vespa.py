@@ -1,16 +1,33 @@
 #!/usr/bin/env python3
 # Copyright Vespa.ai. All rights reserved.
 
+import argparse
+import contextlib
+import hashlib
+import io
 import json
 import os
 import re
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 import yaml
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from requests.adapters import HTTPAdapter, Retry
 import urllib.parse
 
+remove_concurrency = 16
+visit_slices = 4
+visit_page_size = 500
+feed_client = "native"
+feed_concurrency = 32
+journal = None
+metrics = None
+
+
 def find(json, path, separator = "."):
     if len(path) == 0: return json
     head, _, rest = path.partition(separator)
@@ -47,25 +64,87 @@ def vespa_get(endpoint, operation, options):
     return session.get(url).json()
 
 
-def vespa_delete(endpoint, operation, options):
-    url = "{0}/{1}?{2}".format(endpoint, operation, "&".join(options))
-    return session.delete(url).json()
-
-
-def vespa_visit(endpoint, namespace, doc_type, continuation = None):
+def vespa_visit(endpoint, namespace, doc_type, continuation = None, field_set = None, slice_id = 0):
     options = []
-    options.append("wantedDocumentCount=500")
+    options.append("wantedDocumentCount={0}".format(visit_page_size))
     options.append("timeout=60s")
+    if field_set is not None:
+        options.append("fieldSet={0}".format(urllib.parse.quote(field_set)))
+    if visit_slices > 1:
+        options.append("slices={0}".format(visit_slices))
+        options.append("sliceId={0}".format(slice_id))
     if continuation is not None and len(continuation) > 0:
-        options.append("&continuation={0}".format(continuation))
+        options.append("continuation={0}".format(continuation))
     return vespa_get(endpoint, "document/v1/{0}/{1}/docid".format(namespace,doc_type), options)
 
 
+class Throttle:
+    # Bounds the number of requests in flight. The window is halved when the endpoint
+    # pushes back with 429, and grows slowly back to the limit on success.
+    def __init__(self, limit):
+        self.limit = limit
+        self.window = float(limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.window):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.window = max(1.0, self.window / 2)
+            else:
+                self.window = min(float(self.limit), self.window + 1 / self.window)
+            self.condition.notify_all()
+
+
+def get_throttled_count(response):
+    # Requests retried by the Retry adapter are not visible in the response status, but in the retry history
+    retries = getattr(response.raw, "retries", None)
+    history = retries.history if retries is not None else ()
+    throttled = [h for h in history if h.status in (429, 503)]
+    return len(throttled) + (1 if response.status_code in (429, 503) else 0)
+
+
 def vespa_remove(endpoint, doc_ids, namespace, doc_type):
-    options = []
-    for doc_id in doc_ids:
-        id = get_document_id(doc_id)
-        vespa_delete(endpoint, "document/v1/{0}/{1}/docid/{2}".format(namespace, doc_type, id), options)
+    status_counts = {}
+    lock = threading.Lock()
+    throttle = Throttle(remove_concurrency)
+
+    def remove(doc_id):
+        throttled = False
+        try:
+            id = get_document_id(doc_id)
+            url = "{0}/document/v1/{1}/{2}/docid/{3}".format(endpoint, namespace, doc_type, id)
+            response = session.delete(url)
+            throttled = get_throttled_count(response) > 0
+            status = str(response.status_code)
+        except requests.exceptions.RequestException as e:
+            throttled = True
+            status = type(e).__name__
+        except Exception as e:
+            status = type(e).__name__
+        finally:
+            throttle.release(throttled)
+        with lock:
+            status_counts[status] = status_counts.get(status, 0) + 1
+
+    with ThreadPoolExecutor(max_workers=remove_concurrency) as executor:
+        for doc_id in doc_ids:
+            throttle.acquire()
+            executor.submit(remove, doc_id)
+
+    print("Remove status counts: {0}".format(", ".join("{0}: {1}".format(status, count) for status, count in sorted(status_counts.items()))))
+    return status_counts
+
+
+def get_failed_count(status_counts):
+    return sum(count for status, count in status_counts.items() if status != "200")
 
 
 def vespa_feed(endpoint, feed, namespace, doc_type):
@@ -87,44 +166,238 @@ def vespa_feed(endpoint, feed, namespace, doc_type):
 
     if process.returncode != 0:
         print("::error::Errors encountered while feeding Vespa application.")
-        sys.exit(process.returncode)
+        raise RuntimeError("vespa feed exited with code {0}".format(process.returncode))
 
     return process.stdout.decode('utf-8')
 
 
+def get_document_url(endpoint, id):
+    # id:<namespace>:<doc_type>:<key/value-pair>:<user-specified>
+    _, namespace, doc_type, group, docid = id.split(":", 4)
+    path = "docid"
+    if group.startswith("n="):
+        path = "number/{0}".format(group[2:])
+    elif group.startswith("g="):
+        path = "group/{0}".format(urllib.parse.quote(group[2:], safe=""))
+    return "{0}/document/v1/{1}/{2}/{3}/{4}".format(endpoint, namespace, doc_type, path, urllib.parse.quote(docid, safe=""))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+class FeedStats:
+    def __init__(self, total, interval=10):
+        self.total = total
+        self.interval = interval
+        self.start = time.time()
+        self.last_report = self.start
+        self.latencies = []
+        self.status_counts = {}
+        self.errors = []
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def add(self, status, latency, throttled, error=None):
+        with self.lock:
+            self.latencies.append(latency)
+            self.status_counts[status] = self.status_counts.get(status, 0) + 1
+            self.throttled += throttled
+            if error is not None and len(self.errors) < 10:
+                self.errors.append(error)
+
+    def report(self):
+        # Called from the feeding thread, as output of worker threads is not captured per endpoint
+        if time.time() - self.last_report >= self.interval:
+            self.last_report = time.time()
+            with self.lock:
+                summary = self.summary()
+            print(summary)
+            sys.stdout.flush()
+
+    def percentile(self, p):
+        return percentile(self.latencies, p)
+
+    def summary(self):
+        seconds = max(time.time() - self.start, 1e-9)
+        return "{0}/{1} documents, {2:.1f} docs/s, p50 {3:.0f} ms, p99 {4:.0f} ms, throttled {5}, status {6}".format(
+            len(self.latencies), self.total, len(self.latencies) / seconds,
+            self.percentile(0.5) * 1000, self.percentile(0.99) * 1000, self.throttled,
+            ", ".join("{0}: {1}".format(status, count) for status, count in sorted(self.status_counts.items())))
+
+
+def vespa_feed_native(endpoint, operations, total, acknowledge):
+    # Feeds (docid, serialized put operation) pairs to /document/v1 over the shared session, with an adaptive concurrency window
+    stats = FeedStats(total)
+    throttle = Throttle(feed_concurrency)
+    print("Feeding {0} documents to endpoint: {1}".format(total, endpoint))
+
+    def put(docid, operation):
+        start = time.time()
+        throttled = 0
+        error = None
+        try:
+            doc = json.loads(operation)
+            response = session.post(get_document_url(endpoint, doc["put"]), json={"fields": doc["fields"]})
+            throttled = get_throttled_count(response)
+            status = str(response.status_code)
+            if response.status_code != 200:
+                error = "{0}: {1} {2}".format(doc["put"], status, response.text)
+            else:
+                acknowledge(docid)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            # The endpoint is overloaded or unreachable, back off as for throttled responses
+            throttled = 1
+            status = type(e).__name__
+            error = str(e)
+        except Exception as e:
+            status = type(e).__name__
+            error = str(e)
+        finally:
+            throttle.release(throttled > 0)
+        stats.add(status, time.time() - start, throttled, error)
+
+    with ThreadPoolExecutor(max_workers=feed_concurrency) as executor:
+        for docid, operation in operations:
+            throttle.acquire()
+            executor.submit(put, docid, operation)
+            stats.report()
+
+    for error in stats.errors:
+        print("::error::{0}".format(error))
+    failed = sum(count for status, count in stats.status_counts.items() if status != "200")
+    if failed > 0:
+        print("::error::Errors encountered while feeding Vespa application.")
+        raise RuntimeError("{0} of {1} documents failed to feed".format(failed, total))
+    return stats.summary()
+
+
+def feed_documents(endpoint_url, feed_files, docids, namespace, doc_type, acknowledge):
+    # Feeds all documents in the feed files, or only the given document IDs
+    if feed_client == "native":
+        docids = docids if docids is not None else set().union(*[feed_file.docids for feed_file in feed_files])
+        operations = ((docid, feed_file.operations[docid]) for feed_file in feed_files for docid in feed_file.docids.intersection(docids))
+        return vespa_feed_native(endpoint_url, operations, len(docids), acknowledge)
+
+    if docids is None:
+        output = []
+        for feed_file in feed_files:
+            output.append(vespa_feed(endpoint_url, feed_file.path, namespace, doc_type))
+            for docid in feed_file.docids:
+                acknowledge(docid)
+        return "\n".join(output)
+    with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False, encoding="utf-8") as fp:
+        for feed_file in feed_files:
+            feed_file.write_operations(fp, docids)
+    try:
+        output = vespa_feed(endpoint_url, fp.name, namespace, doc_type)
+        for docid in docids:
+            acknowledge(docid)
+        return output
+    finally:
+        os.remove(fp.name)
+
+
 def get_docs(index):
-    file = open(index, "r", encoding='utf-8')
-    return json.load(file)
+    with open(index, "r", encoding='utf-8') as f:
+        if index.endswith(".jsonl"):
+            return [json.loads(line) for line in f if line.strip()]
+        return json.load(f)
 
 
-def get_indexed_docids(endpoint, namespace, doc_type):
-    docids = set()
+def visit_slice(endpoint, namespace, doc_type, field_set, slice_id, process):
+    results = []
     continuation = ""
     while continuation is not None:
-        json = vespa_visit(endpoint, namespace, doc_type, continuation)
+        json = vespa_visit(endpoint, namespace, doc_type, continuation, field_set, slice_id)
         documents = find(json, "documents")
         if documents is not None:
-            ids = [ find(document, "id") for document in documents ]
-            for id in ids:
+            for document in documents:
+                id = find(document, "id")
                 # The document ID might contain chars that needs to be escaped for the delete/put operation to work
                 # also for comparison with what is in the feed
                 docid = get_document_id(id) # return the last part
                 encoded = urllib.parse.quote(docid) #escape
                 id = id.replace(docid, encoded)
-                docids.add(id)
+                results.append(process(id, document.get("fields", {})))
         continuation = find(json, "continuation")
-    return docids
+    return results
 
 
-def get_feed_docids(feed, namespace, doc_type):
-    with open(feed, "r", encoding='utf-8') as f:
-        feed_json = json.load(f)
+def visit_documents(endpoint, namespace, doc_type, field_set, process):
+    # Each slice is an independent continuation chain, visited in parallel
+    with ThreadPoolExecutor(max_workers=visit_slices) as executor:
+        slices = [executor.submit(visit_slice, endpoint, namespace, doc_type, field_set, slice_id, process)
+                  for slice_id in range(visit_slices)]
+        for result in slices:
+            yield from result.result()
+
+
+def get_indexed_docids(endpoint, namespace, doc_type):
+    return set(visit_documents(endpoint, namespace, doc_type, "[id]", lambda id, fields: id))
+
+
+def get_indexed_fingerprints(endpoint, namespace, doc_type, feed_files):
+    # Fingerprints of the indexed documents, using only the fields set in the feed, for comparison with the feed
+    def fingerprint(id, fields):
+        for feed_file in feed_files:
+            if id in feed_file.field_names:
+                return id, get_fingerprint({name: fields.get(name) for name in feed_file.field_names[id]})
+        return id, None
+
+    return dict(visit_documents(endpoint, namespace, doc_type, "{0}:[document]".format(doc_type), fingerprint))
+
+
+def get_feed_docid(doc, namespace, doc_type):
     if doc_type == "doc":
-        return set(["id:{0}:doc::".format(namespace) + find(doc, "fields.namespace") + find(doc, "fields.path") for doc in feed_json])
+        return "id:{0}:doc::".format(namespace) + find(doc, "fields.namespace") + find(doc, "fields.path")
     elif doc_type == "term":
-        return set(["id:{0}:term::".format(namespace) + str(find(doc, "fields.hash")) for doc in feed_json])
+        return "id:{0}:term::".format(namespace) + str(find(doc, "fields.hash"))
     elif doc_type == "paragraph":
-        return set([doc['put'] for doc in feed_json])
+        return doc['put']
+    raise ValueError("Unknown vespa doc_type: {0}".format(doc_type))
+
+
+def get_fingerprint(fields):
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class FeedFile:
+    # Document IDs, field names, content fingerprints and serialized operations of a feed file
+    def __init__(self, path, namespace, doc_type):
+        self.path = path
+        self.fingerprints = {}
+        self.field_names = {}
+        self.operations = {}
+        names = {}
+        for doc in get_docs(path):
+            docid = get_feed_docid(doc, namespace, doc_type)
+            self.fingerprints[docid] = get_fingerprint(doc["fields"])
+            field_names = tuple(sorted(doc["fields"].keys()))
+            self.field_names[docid] = names.setdefault(field_names, field_names)
+            self.operations[docid] = json.dumps(doc)
+        self.docids = set(self.fingerprints.keys())
+
+    def write_operations(self, fp, docids):
+        for docid in self.docids.intersection(docids):
+            fp.write(self.operations[docid])
+            fp.write("\n")
+
+
+feed_files = {}
+feed_files_lock = threading.Lock()
+
+
+def get_feed_file(feed, namespace, doc_type):
+    # Each feed file is parsed once per run, and shared by all endpoints feeding it
+    key = (feed, namespace, doc_type)
+    with feed_files_lock:
+        if key not in feed_files:
+            feed_files[key] = FeedFile(feed, namespace, doc_type)
+        return feed_files[key]
 
 
 def print_header(msg):
@@ -139,9 +412,161 @@ def read_config(config_file):
         return yaml.safe_load(f)
 
 
+class Metrics:
+    # Per endpoint and phase timings and request statistics. Requests are attributed to an endpoint by origin,
+    # and to a phase by method: visits are GET, removals DELETE and feed operations POST.
+    request_phases = {"GET": "visit", "DELETE": "remove", "POST": "feed"}
+
+    def __init__(self):
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def get(self, endpoint, phase):
+        phases = self.endpoints.setdefault(endpoint, {})
+        return phases.setdefault(phase, {"seconds": 0.0, "documents": 0, "requests": 0, "retries": 0,
+                                         "throttled": 0, "bytes_sent": 0, "bytes_received": 0, "latencies": []})
+
+    @contextlib.contextmanager
+    def phase(self, endpoint, phase):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.get(endpoint, phase)["seconds"] += time.time() - start
+
+    def add_documents(self, endpoint, phase, documents):
+        with self.lock:
+            self.get(endpoint, phase)["documents"] += documents
+
+    def observe(self, response, *args, **kwargs):
+        # Response hook for the session
+        url = urllib.parse.urlsplit(response.url)
+        endpoint = "{0}://{1}".format(url.scheme, url.netloc)
+        retries = getattr(response.raw, "retries", None)
+        body = response.request.body
+        with self.lock:
+            metrics = self.get(endpoint, self.request_phases.get(response.request.method, "other"))
+            metrics["requests"] += 1
+            metrics["retries"] += len(retries.history) if retries is not None else 0
+            metrics["throttled"] += get_throttled_count(response)
+            metrics["bytes_sent"] += len(body) if body is not None else 0
+            metrics["bytes_received"] += len(response.content)
+            metrics["latencies"].append(response.elapsed.total_seconds())
+
+    def to_dict(self):
+        result = {}
+        with self.lock:
+            for endpoint, phases in self.endpoints.items():
+                result[endpoint] = {}
+                for phase, metrics in phases.items():
+                    values = {key: value for key, value in metrics.items() if key != "latencies"}
+                    values["documents_per_second"] = metrics["documents"] / metrics["seconds"] if metrics["seconds"] > 0 else 0.0
+                    values["latency_p50"] = percentile(metrics["latencies"], 0.5)
+                    values["latency_p99"] = percentile(metrics["latencies"], 0.99)
+                    result[endpoint][phase] = values
+        return result
+
+    def to_prometheus(self):
+        # Lines of the same metric must be grouped together in the text format
+        metrics = [("feed_phase_seconds", "gauge", "seconds", ""),
+                   ("feed_phase_documents", "gauge", "documents", ""),
+                   ("feed_phase_documents_per_second", "gauge", "documents_per_second", ""),
+                   ("feed_requests_total", "counter", "requests", ""),
+                   ("feed_request_retries_total", "counter", "retries", ""),
+                   ("feed_requests_throttled_total", "counter", "throttled", ""),
+                   ("feed_request_bytes_sent_total", "counter", "bytes_sent", ""),
+                   ("feed_request_bytes_received_total", "counter", "bytes_received", ""),
+                   ("feed_request_latency_seconds", "summary", "latency_p50", ',quantile="0.5"'),
+                   ("feed_request_latency_seconds", "summary", "latency_p99", ',quantile="0.99"')]
+        values = self.to_dict()
+        lines = []
+        for name, metric_type, key, extra_labels in metrics:
+            if not extra_labels or extra_labels.endswith('"0.5"'):
+                lines.append("# TYPE {0} {1}".format(name, metric_type))
+            for endpoint, phases in values.items():
+                for phase, phase_values in phases.items():
+                    labels = 'endpoint="{0}",phase="{1}"{2}'.format(endpoint, phase, extra_labels)
+                    lines.append("{0}{{{1}}} {2}".format(name, labels, phase_values[key]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        with open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+
+
+class FeedJournal:
+    # Append-only JSONL journal of the progress per endpoint, so that a failed run can be resumed.
+    # Entries are keyed by endpoint and run, where the run is a hash of the config and the feed contents.
+    def __init__(self, path=None, batch_size=1000):
+        self.path = path
+        self.batch_size = batch_size
+        self.state = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        if path is not None and os.path.isfile(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if line.strip():
+                        self.apply(json.loads(line))
+
+    def apply(self, entry):
+        state = self.get(entry["endpoint"], entry["run"])
+        if entry.get("reset_fed"):
+            state["fed"] = set()
+        if "phase" in entry:
+            state["phases"].add(entry["phase"])
+        if "to_feed" in entry:
+            state["to_feed"] = None if entry["to_feed"] is None else set(entry["to_feed"])
+        if "fed" in entry:
+            state["fed"].update(entry["fed"])
+
+    def get(self, endpoint, run):
+        return self.state.setdefault((endpoint, run), {"phases": set(), "to_feed": None, "fed": set()})
+
+    def record(self, entry):
+        with self.lock:
+            self.apply(entry)
+            if self.path is not None:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry) + "\n")
+
+    def acknowledge(self, endpoint, run, docid):
+        with self.lock:
+            pending = self.pending.setdefault((endpoint, run), [])
+            pending.append(docid)
+            if len(pending) < self.batch_size:
+                return
+            self.pending[(endpoint, run)] = []
+        self.record({"endpoint": endpoint, "run": run, "fed": pending})
+
+    def flush(self, endpoint, run):
+        with self.lock:
+            pending = self.pending.pop((endpoint, run), [])
+        if pending:
+            self.record({"endpoint": endpoint, "run": run, "fed": pending})
+
+    def remove(self):
+        if self.path is not None and os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+def get_run_key(config, feed_files):
+    search = config["search"]
+    content = [search["namespace"], search["doc_type"], search["do_feed"], search["do_index_removal_before_feed"],
+               search.get("do_diff_feed", False)]
+    for feed_file in feed_files:
+        content.append([feed_file.path, sorted(feed_file.fingerprints.items())])
+    return hashlib.sha256(json.dumps(content).encode("utf-8")).hexdigest()
+
+
 def update_endpoint(endpoint, config):
     do_remove_index = config["search"]["do_index_removal_before_feed"]
     do_feed = config["search"]["do_feed"]
+    do_diff_feed = config["search"].get("do_diff_feed", False)
     namespace = config["search"]["namespace"]
     doc_type = config["search"]["doc_type"]
 
@@ -149,58 +574,269 @@ def update_endpoint(endpoint, config):
     endpoint_url = endpoint_url[:-1] if endpoint_url.endswith("/") else endpoint_url
     endpoint_indexes = endpoint["indexes"]
 
+    # Diffing against the index is pointless if everything is removed before feeding
+    do_diff_feed = do_diff_feed and do_feed and not do_remove_index
+
+    feed_files = []
+    if do_feed:
+        print_header("Parsing feed file(s) for document IDs")
+        with metrics.phase(endpoint_url, "parse"):
+            for index in endpoint_indexes:
+                assert os.path.exists(index)
+                feed_files.append(get_feed_file(index, namespace, doc_type))
+
+    run = get_run_key(config, feed_files)
+    state = journal.get(endpoint_url, run)
+    if "done" in state["phases"]:
+        print("Endpoint {0} was updated with this feed in an earlier run.".format(endpoint_url))
+        return
+
+    failed_removals = 0
+    if "removed" in state["phases"]:
+        print("Resuming {0} from the journal: {1} documents already fed.".format(endpoint_url, len(state["fed"])))
+        docids_to_feed = state["to_feed"]
+    else:
+        if do_remove_index and len(state["fed"]) > 0:
+            # Documents fed in an earlier run are removed again below, and must be fed again
+            print("Removing all documents again: {0} documents fed in an earlier run are fed again.".format(len(state["fed"])))
+            journal.record({"endpoint": endpoint_url, "run": run, "reset_fed": True})
+        docids_to_feed, failed_removals = update_index(endpoint_url, config, feed_files, do_diff_feed)
+        if docids_to_feed is False:
+            return
+        # With failed removals, a resumed run visits and removes again
+        if failed_removals == 0:
+            journal.record({"endpoint": endpoint_url, "run": run, "phase": "removed",
+                            "to_feed": None if docids_to_feed is None else sorted(docids_to_feed)})
+
+    if do_feed:
+        if docids_to_feed is None and len(state["fed"]) > 0:
+            docids_to_feed = set().union(*[feed_file.docids for feed_file in feed_files])
+        if docids_to_feed is not None:
+            docids_to_feed = docids_to_feed.difference(state["fed"])
+
+        def acknowledge(docid):
+            journal.acknowledge(endpoint_url, run, docid)
+            metrics.add_documents(endpoint_url, "feed", 1)
+
+        try:
+            if docids_to_feed is not None:
+                if len(docids_to_feed) > 0:
+                    print("::group::Feeding {0} documents to {1}".format(len(docids_to_feed), endpoint_url))
+                    with metrics.phase(endpoint_url, "feed"):
+                        print(feed_documents(endpoint_url, feed_files, docids_to_feed, namespace, doc_type, acknowledge))
+                    print("::endgroup::")
+                print("{0} documents fed.".format(len(docids_to_feed)))
+            else:
+                for feed_file in feed_files:
+                    print("::group::Feeding {0} to {1}".format(feed_file.path, endpoint_url))
+                    with metrics.phase(endpoint_url, "feed"):
+                        print(feed_documents(endpoint_url, [feed_file], None, namespace, doc_type, acknowledge))
+                    print("::endgroup::")
+                print("{0} documents fed.".format(len(set().union(*[feed_file.docids for feed_file in feed_files]))))
+        finally:
+            journal.flush(endpoint_url, run)
+
+    if failed_removals > 0:
+        raise RuntimeError("{0} documents not in the feed failed to be removed".format(failed_removals))
+    journal.record({"endpoint": endpoint_url, "run": run, "phase": "done"})
+
+
+def update_index(endpoint_url, config, feed_files, do_diff_feed):
+    # Visits the endpoint and removes documents. Returns the document IDs to feed, None to feed everything,
+    # or False if there is nothing to feed, and the number of documents not in the feed that failed to be removed.
+    # Failed removals do not stop the feed, as the index would otherwise be left without the documents removed.
+    do_remove_index = config["search"]["do_index_removal_before_feed"]
+    do_feed = config["search"]["do_feed"]
+    namespace = config["search"]["namespace"]
+    doc_type = config["search"]["doc_type"]
+
     print_header("Retrieving already indexed document IDs for endpoint {0}".format(endpoint_url))
-    docids_in_index = get_indexed_docids(endpoint_url, namespace, doc_type)
+    with metrics.phase(endpoint_url, "visit"):
+        if do_diff_feed:
+            fingerprints_in_index = get_indexed_fingerprints(endpoint_url, namespace, doc_type, feed_files)
+            docids_in_index = set(fingerprints_in_index.keys())
+        else:
+            docids_in_index = get_indexed_docids(endpoint_url, namespace, doc_type)
+    metrics.add_documents(endpoint_url, "visit", len(docids_in_index))
     print("{0} documents found.".format(len(docids_in_index)))
 
     if do_remove_index:
         print_header("Removing all indexed documents in {0}".format(endpoint_url))
-        vespa_remove(endpoint_url, docids_in_index, namespace, doc_type)
-        print("{0} documents removed.".format(len(docids_in_index)))
+        with metrics.phase(endpoint_url, "remove"):
+            status_counts = vespa_remove(endpoint_url, docids_in_index, namespace, doc_type)
+        metrics.add_documents(endpoint_url, "remove", len(docids_in_index))
+        print("{0} documents removed.".format(status_counts.get("200", 0)))
+        failed = get_failed_count(status_counts)
+        if failed > 0:
+            # Documents in the feed are overwritten when fed and the rest are removed again below
+            print("::warning::{0} of {1} document removals failed in {2}".format(failed, len(docids_in_index), endpoint_url))
+
+    if not do_feed:
+        return None, 0
+
+    docids_in_feed = set()
+    for feed_file in feed_files:
+        docids_in_feed = docids_in_feed.union(feed_file.docids)
+    print("{0} documents found.".format(len(docids_in_feed)))
+
+    if len(docids_in_feed) == 0:
+        return False, 0
+
+    docids_to_remove = docids_in_index.difference(docids_in_feed)
+    failed_removals = 0
+    if len(docids_to_remove) > 0:
+        print("::group::Removing indexed documents not in feed in {0}".format(endpoint_url))
+        for id in docids_to_remove:
+            print("To Remove: {0}".format(id))
+        with metrics.phase(endpoint_url, "remove"):
+            status_counts = vespa_remove(endpoint_url, docids_to_remove, namespace, doc_type)
+        metrics.add_documents(endpoint_url, "remove", len(docids_to_remove))
+        print("{0} documents removed.".format(status_counts.get("200", 0)))
+        failed_removals = get_failed_count(status_counts)
+        print("::endgroup::")
+    else:
+        print("No documents to be removed.")
 
-    if do_feed:
-        docids_in_feed = set()
-        print_header("Parsing feed file(s) for document IDs")
-        for index in endpoint_indexes:
-            assert os.path.exists(index)
-            docids_in_feed = docids_in_feed.union(get_feed_docids(index, namespace, doc_type))
-        print("{0} documents found.".format(len(docids_in_feed)))
+    if not do_diff_feed:
+        return None, failed_removals
 
-        if len(docids_in_feed) == 0:
-            return
+    docids_to_feed = set()
+    for feed_file in feed_files:
+        for docid, fingerprint in feed_file.fingerprints.items():
+            if fingerprints_in_index.get(docid) != fingerprint:
+                docids_to_feed.add(docid)
+    print("{0} documents new or changed.".format(len(docids_to_feed)))
+    return docids_to_feed, failed_removals
+
+
+output_lock = threading.Lock()
 
-        docids_to_remove = docids_in_index.difference(docids_in_feed)
-        if len(docids_to_remove) > 0:
-            print("::group::Removing indexed documents not in feed in {0}".format(endpoint_url))
-            for id in docids_to_remove:
-                print("To Remove: {0}".format(id))
-            vespa_remove(endpoint_url, docids_to_remove, namespace, doc_type)
-            print("{0} documents removed.".format(len(docids_to_remove)))
-            print("::endgroup::")
-        else:
-            print("No documents to be removed.")
 
-        for index in endpoint_indexes:
-            print("::group::Feeding {0} to {1}".format(index, endpoint_url))
-            print(vespa_feed(endpoint_url, index, namespace, doc_type))
-            print("::endgroup::")
+class ThreadLocalStdout:
+    # Replaces sys.stdout during parallel updates, each endpoint thread prints to its own buffer until released
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
 
-        print("{0} documents fed.".format(len(docids_in_feed)))
+    def capture(self):
+        self.local.buffer = io.StringIO()
+
+    def release(self):
+        buffer = self.local.buffer
+        self.local.buffer = None
+        with output_lock:
+            self.stdout.write(buffer.getvalue())
+            self.stdout.flush()
+
+    def write(self, s):
+        buffer = getattr(self.local, "buffer", None)
+        return (buffer if buffer is not None else self.stdout).write(s)
+
+    def flush(self):
+        self.stdout.flush()
+
+
+def run_endpoint(endpoint, config, output=None):
+    if output is not None:
+        output.capture()
+    start = time.time()
+    error = None
+    try:
+        update_endpoint(endpoint, config)
+    except Exception as e:
+        print("::error::Updating {0} failed: {1}".format(endpoint["url"], e))
+        error = e
+    result = {"url": endpoint["url"], "seconds": time.time() - start, "error": error}
+    if output is not None:
+        output.release()
+    return result
+
+
+def update_endpoints(endpoints, config, parallel):
+    if parallel <= 1:
+        return [run_endpoint(endpoint, config) for endpoint in endpoints]
+
+    output = ThreadLocalStdout(sys.stdout)
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            return list(executor.map(lambda endpoint: run_endpoint(endpoint, config, output), endpoints))
+    finally:
+        sys.stdout = output.stdout
+
+
+def print_summary(results):
+    print_header("Summary")
+    for result in results:
+        status = "OK" if result["error"] is None else "FAILED: {0}".format(result["error"])
+        print("{0} {1:.1f}s {2}".format(result["url"], result["seconds"], status))
+    failed = [result for result in results if result["error"] is not None]
+    print("{0} endpoints updated, {1} failed.".format(len(results) - len(failed), len(failed)))
+    return len(failed) == 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Synchronize the feed endpoints in a config file with the feed files")
+    parser.add_argument("config", help="config file with feed endpoints, e.g. _paragraphs_config.yml")
+    parser.add_argument("-p", "--parallel", type=int, default=1,
+                        help="number of endpoints to update concurrently (default: 1)")
+    parser.add_argument("--remove-concurrency", type=int, default=remove_concurrency,
+                        help="max number of document removals in flight per endpoint (default: {0})".format(remove_concurrency))
+    parser.add_argument("--visit-slices", type=int, default=visit_slices,
+                        help="number of slices visited in parallel per endpoint (default: {0})".format(visit_slices))
+    parser.add_argument("--visit-page-size", type=int, default=visit_page_size,
+                        help="wanted number of documents per visit response (default: {0})".format(visit_page_size))
+    parser.add_argument("--feed-client", choices=["native", "vespa-cli"], default=feed_client,
+                        help="feed with the built-in document/v1 client or with 'vespa feed' (default: {0})".format(feed_client))
+    parser.add_argument("--feed-concurrency", type=int, default=feed_concurrency,
+                        help="max number of feed operations in flight per endpoint (default: {0})".format(feed_concurrency))
+    parser.add_argument("--journal", metavar="FILE",
+                        help="checkpoint journal, a failed run with the same config and feed resumes where it stopped")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="write per endpoint and phase metrics, in Prometheus text format if FILE ends with .prom, else JSON")
+    parser.add_argument("--diff", action="store_true",
+                        help="only feed documents that are new or changed compared to the index, same as do_diff_feed in the config")
+    return parser.parse_args()
 
 
 def main():
-    configuration_file = sys.argv[1]
-    config = read_config(configuration_file)
+    args = parse_args()
+    config = read_config(args.config)
+    if args.diff:
+        config["search"]["do_diff_feed"] = True
     global session
+    global remove_concurrency
+    global visit_slices
+    global visit_page_size
+    global feed_client
+    global feed_concurrency
+    global journal
+    global metrics
+    remove_concurrency = args.remove_concurrency
+    visit_slices = args.visit_slices
+    visit_page_size = args.visit_page_size
+    feed_client = args.feed_client
+    feed_concurrency = args.feed_concurrency
+    journal = FeedJournal(args.journal)
+    metrics = Metrics()
     session = requests.Session()
+    session.hooks["response"].append(metrics.observe)
+    # Puts to /document/v1 are idempotent, so POST is retried like the other methods
     retries = Retry(total=10, connect=10,
         backoff_factor=0.8,
-        status_forcelist=[ 500, 503, 504, 429 ]
+        status_forcelist=[ 500, 503, 504, 429 ],
+        allowed_methods=None
     )
-    session.mount('https://', HTTPAdapter(max_retries=retries))
+    adapter = HTTPAdapter(max_retries=retries, pool_maxsize=max(remove_concurrency, visit_slices, feed_concurrency))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
     session.cert = (get_public_cert_path(), get_private_key_path())
-    for endpoint in config["search"]["feed_endpoints"]:
-        update_endpoint(endpoint, config)
+    results = update_endpoints(config["search"]["feed_endpoints"], config, args.parallel)
+    if args.metrics:
+        metrics.write(args.metrics)
+    if not print_summary(results):
+        sys.exit(1)
+    journal.remove()
 
 
 if __name__ == "__main__":
@@ -2,24 +2,56 @@
 
 # Copyright Vespa.ai. All rights reserved.
 
+import collections
 import os
 import re
 import sys
+import time
 import random
 import pexpect
 
 
+class Watch:
+    # Searches output for a pattern as it arrives, keeping only the last window characters between chunks
+    def __init__(self, pattern, window):
+        self.pattern = pattern
+        self.window = window
+        self.tail = ""
+        self.match = None
+
+    def feed(self, s):
+        if self.match is None:
+            text = self.tail + s
+            self.match = self.pattern.search(text)
+            self.tail = text[-self.window:]
+
+
 class Log:
-    def __init__(self):
+    def __init__(self, max_size=None):
         self._log = None
+        self._size = 0
+        self._max_size = max_size
+        self._spill = None
+        self._watches = []
         self._filter_pattern = None
         self._verbose = False
         self.reset_log()
 
     def reset_log(self, verbose=False):
-        self._log = []
+        self._log = collections.deque()
+        self._size = 0
+        self._watches = []
         self._verbose = verbose
 
+    def spill_to(self, f):
+        # All output is also written to f, also when the log in memory is capped
+        self._spill = f
+
+    def watch(self, pattern, window):
+        watch = Watch(pattern, window)
+        self._watches.append(watch)
+        return watch
+
     def stdout_filter(self, pattern):
         self._filter_pattern = pattern
 
@@ -27,9 +59,23 @@ class Log:
         return "".join(self._log)
 
     def write(self, s):
+        if self._spill is not None:
+            self._spill.write(s)
+        for watch in self._watches:
+            watch.feed(s)
         self._log.append(s)
-        if re.match(self._filter_pattern, s) is None:
-            if self._verbose:
+        self._size += len(s)
+        if self._max_size is not None:
+            # Keep only the last max_size characters, as a ring buffer of chunks
+            while self._size > self._max_size:
+                excess = self._size - self._max_size
+                if len(self._log[0]) <= excess:
+                    self._size -= len(self._log.popleft())
+                else:
+                    self._log[0] = self._log[0][excess:]
+                    self._size -= excess
+        if self._verbose:
+            if self._filter_pattern is None or re.match(self._filter_pattern, s) is None:
                 sys.stdout.write(s)
 
     def flush(self):
@@ -37,10 +83,14 @@ class Log:
 
 
 class PseudoTerminal:
-    def __init__(self, timeout=30*60):
-        self._log = Log()
+    def __init__(self, timeout=30*60, cwd=None, max_log_size=None, log_file=None):
+        self._log = Log(max_log_size)
+        self._log_file = log_file
+        self._spill = None
+        self._output_watch = None
         self._pty = None
         self._cmd_timeout = timeout
+        self.cwd = cwd if cwd is not None else os.getcwd()
 
     def __enter__(self):
         self.start()
@@ -53,45 +103,85 @@ class PseudoTerminal:
         env = os.environ.copy()
         env["PS1"] = ""  # remove default terminal prompt
         env["PS2"] = ""
-        self._pty = pexpect.spawn('sh', env=env, echo=False, encoding='utf-8')
+        if self._log_file is not None:
+            self._spill = open(self._log_file, "a", encoding="utf-8")
+            self._log.spill_to(self._spill)
+        self._pty = pexpect.spawn('sh', cwd=self.cwd, env=env, echo=False, encoding='utf-8')
         self._pty.logfile_read = self._log
 
     def stop(self):
         self._pty.close()
-
-    def run(self, command, verbose):
+        if self._spill is not None:
+            self._spill.close()
+
+    def read_until(self, watches, timeout):
+        # Output is read here instead of with pexpect's expect, which keeps all output since the last match
+        # in memory, and searches all of it for each chunk read. Watches are matched as chunks are logged.
+        # Returns False on timeout.
+        end = time.time() + timeout
+        while all(watch.match is None for watch in watches):
+            remaining = end - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                self._pty.read_nonblocking(size=65536, timeout=min(remaining, 1))
+            except pexpect.TIMEOUT:
+                pass
+            except pexpect.EOF:
+                raise RuntimeError("Unexpected EOF in pseudo-terminal")
+        return True
+
+    def run(self, command, verbose, watch=None):
         command_id = random.randint(10000, 100000)
         sentinel = "sentinel-{0}> exit code: ".format(command_id)
         sentinel_pattern = re.compile(sentinel + "(\\d+)")
 
         self._log.reset_log(verbose)
         self._log.stdout_filter(sentinel_pattern)
+        done = self._log.watch(re.compile(sentinel + "(\\d+)\\r?\\n"), len(sentinel) + 16)
+        self._output_watch = self._log.watch(re.compile(re.escape(watch)), len(watch)) if watch else None
         self._pty.sendline(command)
         self._pty.sendline("echo \"" + sentinel + "$?\"")
 
-        index = self._pty.expect([sentinel_pattern, pexpect.EOF, pexpect.TIMEOUT], timeout=self._cmd_timeout)
-        if index == 0:
-            if self._pty.match is not None:
-                exit_code = int(self._pty.match.group(1))
-                output = self._log.get_log()
-                return exit_code, output
-            raise RuntimeError("Unexpected state: Found pattern, but not regexp match.")
-        if index == 1:
-            raise RuntimeError("Unexpected EOF in pseudo-terminal")
-        if index == 2:
+        if not self.read_until([done], self._cmd_timeout):
             raise RuntimeError("Timeout in execution of {}".format(command))
-        raise RuntimeError("Unexpected state")
+        exit_code = int(done.match.group(1))
+        output = self._log.get_log()
+        return exit_code, output
+
+    def matched(self):
+        # Whether the text to watch for in the last run was in its output, also if the log is capped
+        return self._output_watch is not None and self._output_watch.match is not None
 
     def run_expect(self, command, expect, timeout, verbose):
         self._log.reset_log(verbose)
+        expected = self._log.watch(re.compile(expect, re.DOTALL), 64 * 1024)
         self._pty.sendline(command)
 
-        index = self._pty.expect([expect, pexpect.EOF, pexpect.TIMEOUT], timeout=int(timeout))
-        if index == 0:
-            return 0, self._log.get_log()
-        if index == 1:
-            raise RuntimeError("Unexpected EOF in pseudo-terminal")
-        if index == 2:
+        if not self.read_until([expected], int(timeout)):
             raise RuntimeError("Timeout in execution of {}".format(command))
-        raise RuntimeError("Unexpected state")
+        return 0, self._log.get_log()
+
+    def run_until(self, command, expect, timeout, verbose):
+        # Runs a long-running command, like following a log, only until expect is in its output, then interrupts it.
+        # Returns whether expect was found, and the output - the command can also end or time out first.
+        command_id = random.randint(10000, 100000)
+        sentinel = "sentinel-{0}> exit code: ".format(command_id)
+        sentinel_pattern = re.compile(sentinel + "(\\d+)")
+
+        self._log.reset_log(verbose)
+        self._log.stdout_filter(sentinel_pattern)
+        found = self._log.watch(re.compile(re.escape(expect)), len(expect))
+        done = self._log.watch(re.compile(sentinel + "(\\d+)\\r?\\n"), len(sentinel) + 16)
+        self._pty.sendline(command)
+        self._pty.sendline("echo \"" + sentinel + "$?\"")
+
+        self.read_until([found, done], timeout)
+        if done.match is None:
+            # Interrupt the command with Ctrl-C. This also discards the pending sentinel line, so send it again.
+            self._pty.sendintr()
+            self._pty.sendline("echo \"" + sentinel + "$?\"")
+            if not self.read_until([done], 60):
+                raise RuntimeError("Could not interrupt {}".format(command))
+        return found.match is not None, self._log.get_log()
 
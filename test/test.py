@@ -5,12 +5,17 @@ import io
 import os
 import sys
 import getopt
+import hashlib
 import json
+import shutil
 import time
 import yaml
+import subprocess
 import urllib.request
 import tempfile
+import threading
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 from bs4 import BeautifulSoup
 
@@ -39,9 +44,27 @@ def remove_liquid_highlight(text):
 
 verbose = False
 workdir = "."
+jobs = 1
+wait_interval = 0.5
+wait_max_interval = 5
+max_log_size = None
+spill_logs = False
+changed_range = None
 project_root = os.getcwd()
 work_dir = os.path.join(project_root, "_work")
 liquid_transforms = {}
+liquid_patterns = []
+script_cache_dir = os.path.join(work_dir, "scripts")
+script_cache_version = 1
+output_lock = threading.Lock()
+page_stats = threading.local()
+fixtures = {}
+fixtures_lock = threading.Lock()
+
+def file_name_part(text):
+    # Pages and fixtures are named by URLs and free text, which are not valid in file names
+    return re.sub(r"[^\w.-]+", "_", text)
+
 
 def print_separator():
     print("")
@@ -57,22 +80,32 @@ def print_cmd(cmd, extra=""):
 
 
 def exec_wait(cmd, pty):
+    if cmd.get("wait-mode") == "stream":
+        return exec_wait_stream(cmd, pty)
+
     command = cmd["$"]
     expect = cmd["wait-for"]
     max_wait = 300 if not ("timeout" in cmd) else int(cmd["timeout"])
-    try_interval = 5  # todo: max this configurable too
+    # Poll quickly at first, then back off exponentially up to the max interval
+    try_interval = float(cmd.get("interval", wait_interval))
+    max_interval = float(cmd.get("max-interval", wait_max_interval))
     print_cmd(command, "Waiting for '{0}'".format(expect))
 
+    start = time.time()
     waited = 0
     output = ""
-    while waited < max_wait:
-        exit_code, output = pty.run(command, verbose)
-        if output.find(expect) >= 0:
-            return
-        else:
-            time.sleep(try_interval)
-            waited += try_interval
-            print("Waited for {0}/{1} seconds...".format(waited, max_wait))
+    try:
+        while waited < max_wait:
+            exit_code, output = pty.run(command, verbose, watch=expect)
+            if pty.matched():
+                return
+            else:
+                time.sleep(try_interval)
+                waited = time.time() - start
+                try_interval = min(try_interval * 2, max_interval)
+                print("Waited for {0:.1f}/{1} seconds...".format(waited, max_wait))
+    finally:
+        page_stats.wait_seconds = getattr(page_stats, "wait_seconds", 0) + time.time() - start
 
     if waited >= max_wait:
         if not verbose:
@@ -80,13 +113,33 @@ def exec_wait(cmd, pty):
         raise RuntimeError("Expected output '{0}' not found in command '{1}'. Waited for {2} seconds.".format(expect, command, max_wait))
 
 
+def exec_wait_stream(cmd, pty):
+    # Runs the command once and follows its output, instead of running it again until the output is found
+    command = cmd["$"]
+    expect = cmd["wait-for"]
+    max_wait = 300 if not ("timeout" in cmd) else int(cmd["timeout"])
+    print_cmd(command, "Following output until '{0}'".format(expect))
+
+    start = time.time()
+    try:
+        found, output = pty.run_until(command, expect, max_wait, verbose)
+    finally:
+        page_stats.wait_seconds = getattr(page_stats, "wait_seconds", 0) + time.time() - start
+    print("Waited for {0:.1f}/{1} seconds".format(time.time() - start, max_wait))
+
+    if not found:
+        if not verbose:
+            print(output)
+        raise RuntimeError("Expected output '{0}' not found in command '{1}'. Waited for {2} seconds.".format(expect, command, max_wait))
+
+
 def exec_assert(cmd, pty):
     command = cmd["$"]
     expect = cmd["contains"]
     print_cmd(command, "Expecting '{0}'".format(expect))
 
-    _, output = pty.run(command, verbose)
-    if output.find(expect) == -1:
+    _, output = pty.run(command, verbose, watch=expect)
+    if not pty.matched():
         if not verbose:
             print(output)
         raise RuntimeError("Expected output '{0}' not found in command '{1}'".format(expect, command))
@@ -95,12 +148,13 @@ def exec_assert(cmd, pty):
 def exec_file(cmd, pty):
     path = cmd["path"]
     print_cmd(path)
-    path_array = []
+    # Files are written relative to the page's work dir, which is where the terminal runs
+    path_array = [pty.cwd]
     for dir in path.split(os.path.sep)[:-1]:
         path_array.append(dir)
         if not os.path.isdir(os.path.sep.join(path_array)):
             os.makedirs(os.path.sep.join(path_array))
-    with open(str(path), "w") as f:
+    with open(os.path.join(pty.cwd, path), "w") as f:
         data = str(cmd["content"])
         clean_data = remove_liquid_highlight(data)
         f.write(clean_data)
@@ -136,14 +190,67 @@ def exec_step(cmd, pty):
     globals()["exec_" + cmd["type"]](cmd, pty)
 
 
+def new_terminal(cwd):
+    # With --spill-logs, all terminal output is written next to the work dir, also when --max-log-size caps it in memory
+    log_file = cwd + ".terminal.log" if spill_logs else None
+    return PseudoTerminal(timeout=2*60*60, cwd=cwd, max_log_size=max_log_size, log_file=log_file)
+
+
+def fixture_key(fixture):
+    content = json.dumps([fixture["name"], fixture["steps"]], sort_keys=True)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def prepare_fixture(fixture):
+    # Runs the fixture steps once per run, in a directory of their own, and returns the directory.
+    # Pages with the same fixture steps get a copy of the files in it. Shell state like variables,
+    # the current directory and started processes is not part of the fixture.
+    # A failed fixture is not run again: later pages using it fail with the same error.
+    key = fixture_key(fixture)
+    with fixtures_lock:
+        if key not in fixtures:
+            fixtures[key] = {"lock": threading.Lock(), "dir": None, "error": None}
+        entry = fixtures[key]
+
+    with entry["lock"]:
+        if entry["error"] is not None:
+            raise RuntimeError("Fixture {0} failed: {1}".format(fixture["name"], entry["error"]))
+        if entry["dir"] is not None:
+            print_info("Reusing fixture", fixture["name"])
+            return entry["dir"]
+
+        print_info("Setting up fixture", fixture["name"])
+        fixture_dir = tempfile.mkdtemp(dir=work_dir, prefix="fixture-" + file_name_part(fixture["name"]) + "-")
+        try:
+            with new_terminal(fixture_dir) as pty:
+                for cmd in fixture["steps"]:
+                    exec_step(cmd, pty)
+        except Exception as e:
+            entry["error"] = str(e)
+            shutil.rmtree(fixture_dir, ignore_errors=True)
+            raise
+        entry["dir"] = fixture_dir
+        return fixture_dir
+
+
+def remove_fixtures():
+    with fixtures_lock:
+        for entry in fixtures.values():
+            if entry["dir"] is not None:
+                shutil.rmtree(entry["dir"], ignore_errors=True)
+        fixtures.clear()
+
+
 def exec_script(script):
     tmpdir = tempfile.mkdtemp(dir=work_dir)
-    os.chdir(tmpdir)
 
     failed = False
+    page_stats.wait_seconds = 0
 
-    with PseudoTerminal(timeout=2*60*60) as pty:
+    with new_terminal(tmpdir) as pty:
         try:
+            if "fixture" in script:
+                shutil.copytree(prepare_fixture(script["fixture"]), tmpdir, symlinks=True, dirs_exist_ok=True)
             for cmd in script["before"]:
                 exec_step(cmd, pty)
             for cmd in script["steps"]:
@@ -159,6 +266,7 @@ def exec_script(script):
                     sys.stderr.write("ERROR: {0}\n".format(e))
                     failed = True
 
+    print_info("Waited {0:.1f} seconds in wait steps".format(page_stats.wait_seconds))
     if failed:
         raise RuntimeError("One or more commands failed")
 
@@ -178,13 +286,11 @@ def parse_cmd(cmd, attrs):
         return None
 
     if "data-test-wait-for" in attrs:
-        if "data-test-timeout" in attrs:
-            return {"$": cmd,
-                    "type": "wait",
-                    "wait-for": attrs["data-test-wait-for"],
-                    "timeout": attrs["data-test-timeout"]}
-        else:
-            return {"$": cmd, "type": "wait", "wait-for": attrs["data-test-wait-for"]}
+        wait = {"$": cmd, "type": "wait", "wait-for": attrs["data-test-wait-for"]}
+        for key in ["timeout", "interval", "max-interval", "wait-mode"]:
+            if "data-test-" + key in attrs:
+                wait[key] = attrs["data-test-" + key]
+        return wait
     if "data-test-assert-contains" in attrs:
         return {"$": cmd, "type": "assert", "contains": attrs["data-test-assert-contains"]}
     if "data-test-expect" in attrs:
@@ -192,19 +298,19 @@ def parse_cmd(cmd, attrs):
     return {"$": cmd, "type": "default"}
 
 
-def process_liquid(command):
-    for key, value in liquid_transforms.items():
-        command = re.sub(key, value, command)
+def process_liquid(command, patterns=None):
+    for pattern, value in (liquid_patterns if patterns is None else patterns):
+        command = pattern.sub(value, command)
 
     return command
 
 
-def parse_cmds(pre, attrs):
+def parse_cmds(pre, attrs, patterns=None):
     cmds = []
     line_continuation = ""
     line_continuation_delimiter = "\\"
 
-    sanitized_cmd = process_liquid(pre)
+    sanitized_cmd = process_liquid(pre, patterns)
 
     for line in sanitized_cmd.split("\n"):
         cmd = "{0} {1}".format(line_continuation, line.strip())
@@ -236,7 +342,14 @@ def parse_file(pre, attrs):
     return {"type": "file", "content": content, "path": path}
 
 
-def parse_page(html):
+def fixture_steps(script, name):
+    fixture = script.setdefault("fixture", {"name": name, "steps": []})
+    if fixture["name"] != name:
+        raise ValueError("Only one fixture per page is supported, found '{0}' and '{1}'".format(fixture["name"], name))
+    return fixture["steps"]
+
+
+def parse_page(html, patterns=None):
     script = {
         "before": [],
         "steps": [],
@@ -246,23 +359,62 @@ def parse_page(html):
     soup = BeautifulSoup(html, "html.parser")
 
     for pre in soup.find_all(lambda tag: (tag.name == "pre" or tag.name == "div") and tag.has_attr("data-test")):
+        # Setup marked as a fixture is run once, and its files reused by pages with the same fixture
+        if "data-test-fixture" in pre.attrs and pre.attrs["data-test"] in ["before", "file"]:
+            steps = fixture_steps(script, pre.attrs["data-test-fixture"])
+            if pre.attrs["data-test"] == "file":
+                steps.append(parse_file(pre.contents, pre.attrs))
+            else:
+                steps.extend(parse_cmds(pre.string, pre.attrs, patterns))
+            continue
+
         if pre.attrs["data-test"] == "before":
-            script["before"].extend(parse_cmds(pre.string, pre.attrs))
+            script["before"].extend(parse_cmds(pre.string, pre.attrs, patterns))
 
         if pre.attrs["data-test"] == "exec":
-            script["steps"].extend(parse_cmds(pre.string, pre.attrs))
+            script["steps"].extend(parse_cmds(pre.string, pre.attrs, patterns))
 
         if pre.attrs["data-test"] == "file":
             script["steps"].append(parse_file(pre.contents, pre.attrs))
 
         if pre.attrs["data-test"] == "after":
-            script["after"].extend(parse_cmds(pre.string, pre.attrs))
+            script["after"].extend(parse_cmds(pre.string, pre.attrs, patterns))
+
+    return script
 
+
+def script_key(html, transforms):
+    # Scripts depend on the page content and the site variables substituted into commands
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+    transforms = json.dumps([script_cache_version, sorted((key, str(value)) for key, value in transforms.items())])
+    return hashlib.sha256(html + transforms.encode("utf-8")).hexdigest()
+
+
+def load_script(html, transforms=None):
+    # Parsed scripts are cached in the work dir, so unchanged pages are not parsed again.
+    # Other transforms than the loaded ones can be given, e.g. from another revision of _config.yml.
+    path = os.path.join(script_cache_dir, script_key(html, liquid_transforms if transforms is None else transforms) + ".json")
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            return json.load(f)
+
+    patterns = None if transforms is None else [(re.compile(key), value) for key, value in transforms.items()]
+    script = parse_page(html, patterns)
+    os.makedirs(script_cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=script_cache_dir)
+    with os.fdopen(fd, "w") as f:
+        json.dump(script, f)
+    os.replace(tmp_path, path)
     return script
 
 
+def script_hash(script):
+    return hashlib.sha256(json.dumps(script, sort_keys=True).encode("utf-8")).hexdigest()
+
+
 def process_page(html, source_name=""):
-    script = parse_page(html)
+    script = load_script(html)
 
     print_info("Script to execute:", extra=source_name)
     print(json.dumps(script, indent=2))
@@ -280,9 +432,7 @@ def create_work_dir():
         os.makedirs(work_dir)
 
 
-def run_url(url):
-    print_separator()
-    print_info("Testing", url)
+def read_pages(url):
     allpages = b""
     for page in url.split(","):
         page = page.strip()
@@ -291,49 +441,228 @@ def run_url(url):
         else:
             with open(workdir + '/' + page, 'rb') as f:
                 allpages += f.read()
+    return allpages
 
-    process_page(allpages, url)
 
+def run_url(url):
+    print_separator()
+    print_info("Testing", url)
+    process_page(read_pages(url), url)
 
-def run_config(config_file):
-    failed = []
+
+class ThreadLocalOutput:
+    # Stands in for sys.stdout or sys.stderr while pages run in parallel. A page thread
+    # writes to its own buffer between capture() and release(), other threads to the stream.
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self, buffer):
+        self.local.buffer = buffer
+
+    def release(self):
+        self.local.buffer = None
+
+    def write(self, s):
+        buffer = getattr(self.local, "buffer", None)
+        return (buffer if buffer is not None else self.stream).write(s)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def run_page(url, stdout=None, stderr=None):
+    # With captured output, the page's output is written to a log file in the work dir,
+    # and printed in one piece when the page is done
+    buffer = None
+    if stdout is not None:
+        buffer = io.StringIO()
+        stdout.capture(buffer)
+        stderr.capture(buffer)
+    start = time.time()
+    failed = False
+    page_stats.wait_seconds = 0
+    try:
+        run_url(url)
+    except RuntimeError:
+        failed = True
+    finally:
+        if buffer is not None:
+            stdout.release()
+            stderr.release()
+            log_file = os.path.join(work_dir, file_name_part(url) + ".log")
+            with open(log_file, "w") as f:
+                f.write(buffer.getvalue())
+            with output_lock:
+                stdout.stream.write(buffer.getvalue())
+                stdout.stream.write("* Log of {0} written to {1}\n".format(url, log_file))
+                stdout.stream.flush()
+    return {"url": url, "seconds": time.time() - start, "wait_seconds": page_stats.wait_seconds, "failed": failed}
+
+
+def run_pages(urls):
+    if jobs <= 1:
+        return [run_page(url) for url in urls]
+
+    stdout = ThreadLocalOutput(sys.stdout)
+    stderr = ThreadLocalOutput(sys.stderr)
+    sys.stdout = stdout
+    sys.stderr = stderr
+    try:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(lambda url: run_page(url, stdout, stderr), urls))
+    finally:
+        sys.stdout = stdout.stream
+        sys.stderr = stderr.stream
+
+
+def print_summary(results):
+    print_separator()
+    print_info("Summary")
+    print("{0:7} {1:>9} {2:>9}  {3}".format("", "total", "waiting", "page"))
+    for result in results:
+        print("{0:7} {1:8.1f}s {2:8.1f}s  {3}".format("FAILED" if result["failed"] else "OK",
+                                                  result["seconds"], result["wait_seconds"], result["url"]))
+
+
+def find_config(config_file):
     if not os.path.isfile(config_file):
         config_file = os.path.join("test", config_file)
     if not os.path.isfile(config_file):
         raise RuntimeError("Could not find configuration file")
+    return config_file
 
-    with open(config_file, "r") as f:
+
+def read_config(config_file):
+    with open(find_config(config_file), "r") as f:
         config = yaml.safe_load(f)
-        for url in config["urls"]:
-            try:
-                run_url(url)
-            except RuntimeError:
-                failed.append(url)
+    return config["urls"]
+
+
+def git(*args):
+    return subprocess.run(["git", "-C", workdir] + list(args), check=True, capture_output=True, text=True).stdout
+
+
+def git_show(revision, path):
+    # Content of a file in the given revision, or None if it does not exist there
+    result = subprocess.run(["git", "-C", workdir, "show", "{0}:./{1}".format(revision, path)], capture_output=True)
+    return result.stdout if result.returncode == 0 else None
+
+
+def git_base(changes):
+    # The revision changes are compared to: the merge base for A...B, else A for A..B or A
+    if "..." in changes:
+        start, end = changes.split("...", 1)
+        return git("merge-base", start or "HEAD", end or "HEAD").strip()
+    return changes.split("..", 1)[0] or "HEAD"
+
+
+def select_changed(urls, changes, config_file):
+    # Selects the test units affected by the changes in a git diff range, with the pages checked out as the end of it:
+    # units with a changed page, and units with a script changed in other ways, i.e. by site variables in _config.yml.
+    # All units are selected if the test runner or configuration changed.
+    # Units with pages fetched from URLs can not be checked, and are always selected.
+    changed = set(os.path.realpath(os.path.join(workdir, path))
+                  for path in git("diff", "--name-only", "--relative", changes).splitlines())
+    test_dir = os.path.dirname(os.path.realpath(__file__))
+    runner = [os.path.join(test_dir, "test.py"), os.path.join(test_dir, "pseudo_terminal.py"),
+              os.path.realpath(find_config(config_file))]
+    run_all = any(path in changed for path in runner)
+
+    base_transforms = None
+    if os.path.realpath(os.path.join(workdir, "_config.yml")) in changed:
+        base_config = git_show(git_base(changes), "_config.yml")
+        base_transforms = site_liquid_transforms(yaml.safe_load(base_config) if base_config is not None else {})
+
+    selected = []
+    for url in urls:
+        pages = [page.strip() for page in url.split(",")]
+        reason = None
+        if run_all:
+            reason = "test runner or configuration changed"
+        elif any(page.startswith("http") for page in pages):
+            reason = "pages from URLs"
+        elif any(os.path.realpath(os.path.join(workdir, page)) in changed for page in pages):
+            reason = "page changed"
+        elif base_transforms is not None:
+            html = read_pages(url)
+            if load_script(html) != load_script(html, base_transforms):
+                reason = "script changed"
+        print_info("{0}: {1}".format("Selected" if reason else "Skipped", url), "({0})".format(reason) if reason else "")
+        if reason:
+            selected.append(url)
+    return selected
+
+
+def run_config(config_file):
+    urls = read_config(config_file)
+    if changed_range is not None:
+        urls = select_changed(urls, changed_range, config_file)
+        if len(urls) == 0:
+            print_info("No tests affected by changes in", changed_range)
+            return
 
+    try:
+        results = run_pages(urls)
+    finally:
+        remove_fixtures()
+    print_summary(results)
+
+    failed = [result["url"] for result in results if result["failed"]]
     if len(failed) > 0:
         raise RuntimeError("Tests in " + ", ".join(failed) + " failed")
 
 
+def list_config(config_file):
+    # One line per test unit, with a hash of its script, so runs can be compared to find changed scripts
+    for url in read_config(config_file):
+        script = load_script(read_pages(url))
+        print("{0}  {1:3} before {2:3} steps {3:3} after  {4}".format(
+            script_hash(script)[:12], len(script["before"]), len(script["steps"]), len(script["after"]), url))
+
+
+def extract_config(config_file, extract_dir):
+    # Writes the script of each test unit to a file named after it, to be diffed between revisions
+    os.makedirs(extract_dir, exist_ok=True)
+    for url in read_config(config_file):
+        script = load_script(read_pages(url))
+        path = os.path.join(extract_dir, file_name_part(url) + ".json")
+        with open(path, "w") as f:
+            json.dump(script, f, indent=2, sort_keys=True)
+        print("Wrote " + path)
+
+
 def run_file(file_name):
-    if file_name.startswith("http"):
-        run_url(file_name)
-    elif file_name == "-":
-        process_page(sys.stdin.read(), "stdin")
-    else:
-        with io.open(file_name, 'r', encoding="utf-8") as f:
-            process_page(f.read(), file_name)
+    try:
+        if file_name.startswith("http"):
+            run_url(file_name)
+        elif file_name == "-":
+            process_page(sys.stdin.read(), "stdin")
+        else:
+            with io.open(file_name, 'r', encoding="utf-8") as f:
+                process_page(f.read(), file_name)
+    finally:
+        remove_fixtures()
 
 
 def run_with_arguments():
     global verbose
     global workdir 
+    global jobs
+    global wait_interval
+    global wait_max_interval
+    global max_log_size
+    global spill_logs
+    global changed_range
     config_file = ""
+    mode = "run"
+    extract_dir = None
     argv = sys.argv[1:]
 
     try:
-        opts, args = getopt.getopt(argv, "vc:w:")
+        opts, args = getopt.getopt(argv, "vc:w:j:", ["interval=", "max-interval=", "max-log-size=", "spill-logs", "list", "extract=", "changed="])
     except getopt.GetoptError:
-        print("test.py [-v] [-c configfile] -w [workdir] [file-to-run]")
+        print("test.py [-v] [-c configfile] -w [workdir] [-j parallel-pages] [--interval seconds] [--max-interval seconds] [--max-log-size chars] [--spill-logs] [--list | --extract dir] [--changed git-range] [file-to-run]")
         sys.exit(2)
 
     for opt, arg in opts:
@@ -343,10 +672,31 @@ def run_with_arguments():
             config_file = arg
         elif opt in "-w":
             workdir = arg
+        elif opt in "-j":
+            jobs = int(arg)
+        elif opt == "--interval":
+            wait_interval = float(arg)
+        elif opt == "--max-interval":
+            wait_max_interval = float(arg)
+        elif opt == "--max-log-size":
+            max_log_size = int(arg)
+        elif opt == "--spill-logs":
+            spill_logs = True
+        elif opt == "--list":
+            mode = "list"
+        elif opt == "--extract":
+            mode = "extract"
+            extract_dir = arg
+        elif opt == "--changed":
+            changed_range = arg
 
     load_liquid_transforms()
 
-    if len(config_file):
+    if mode == "list":
+        list_config(config_file if len(config_file) else "_test_config.yml")
+    elif mode == "extract":
+        extract_config(config_file if len(config_file) else "_test_config.yml", extract_dir)
+    elif len(config_file):
         run_config(config_file)
     elif args:
         run_file(args[0])
@@ -354,6 +704,21 @@ def run_with_arguments():
         run_config("_test_config.yml")
 
 
+def site_liquid_transforms(config):
+    transforms = {}
+    # Transforms for site variables like {{site.variables.vespa_version}}
+    if "variables" in config:
+        for key, value in config["variables"].items():
+            transforms[r"{{\s*site.variables."+key+r"\s*}}"] = value
+
+    # Remove liquid macros, e.g.:
+    # {% highlight shell %}       {% endhighlight %}
+    # {% raw %}                   {% endraw %}
+    transforms[r"{%\s*.*highlight\s*.*%}"] = ""
+    transforms[r"{%\s*.*raw\s*%}"] = ""
+    return transforms
+
+
 def load_liquid_transforms():
     global liquid_transforms
     global workdir
@@ -367,18 +732,11 @@ def load_liquid_transforms():
     if not os.path.isfile(site_config):
         raise RuntimeError("Could not find " + site_config_file)
 
-    # Transforms for site variables like {{site.variables.vespa_version}}
     with open(site_config, "r") as f:
-        config = yaml.safe_load(f)
-        if "variables" in config:
-            for key, value in config["variables"].items():
-                liquid_transforms[r"{{\s*site.variables."+key+r"\s*}}"] = value
+        liquid_transforms.update(site_liquid_transforms(yaml.safe_load(f)))
 
-    # Remove liquid macros, e.g.:
-    # {% highlight shell %}       {% endhighlight %}
-    # {% raw %}                   {% endraw %}
-    liquid_transforms[r"{%\s*.*highlight\s*.*%}"] = ""
-    liquid_transforms[r"{%\s*.*raw\s*%}"] = ""
+    global liquid_patterns
+    liquid_patterns = [(re.compile(key), value) for key, value in liquid_transforms.items()]
 
 
 def main():